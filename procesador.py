@@ -5,18 +5,30 @@ Convierte texto desordenado (correos, facturas, quejas) en JSON estructurado
 listo para inserción en base de datos SQL, utilizando la API de OpenAI.
 """
 
-import json
+import argparse
+import asyncio
+import functools
+import hashlib
 import os
+import random
 import sys
+import time
 import logging
-from datetime import datetime
+import re
+import zipfile
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from typing import Optional
+from typing import AsyncIterator, Literal, Optional, Union
 
-import openpyxl
+import msgspec
+import orjson
 import pdfplumber
-from docx import Document
-from openai import OpenAI
+import pypdfium2 as pdfium
+import tiktoken
+from openai import APIStatusError, AsyncOpenAI, RateLimitError
+from python_calamine import CalamineError, CalamineWorkbook
 from dotenv import load_dotenv
 
 # ── Configuración ────────────────────────────────────────────────────────────
@@ -26,13 +38,83 @@ load_dotenv()
 BASE_DIR = Path(__file__).resolve().parent
 INPUT_DIR = BASE_DIR / "datos_entrada"
 OUTPUT_DIR = BASE_DIR / "datos_salida"
+CACHE_DIR = BASE_DIR / "cache"
+CACHE_SEMANTICA_RUTA = CACHE_DIR / "semantica.pkl"
 
 MAX_REINTENTOS = 3
+MAX_CONCURRENCIA = 20  # Peticiones simultáneas a OpenAI
+DOCS_POR_PETICION = 5  # Documentos agrupados en una sola petición
+# Límites de la cuenta; se detectan al iniciar y estos valores son el respaldo
+RPM_POR_DEFECTO = 500
+TPM_POR_DEFECTO = 200_000
+FRACCION_LIMITES = 0.9  # Margen de seguridad sobre los límites detectados
+TOKENS_RESPUESTA_POR_DOC = 60  # Estimación de tokens de salida por documento
+ESPERA_LIMITE_TASA = 15  # Segundos de pausa global tras un 429 sin Retry-After (se duplica por intento)
+MAX_TOKENS_TEXTO = 4000  # Tokens máximos enviados por documento
+PROPORCION_INICIO = 0.75  # Fracción de MAX_TOKENS_TEXTO tomada del inicio al recortar
+CARACTERES_POR_TOKEN = 4  # Aproximación usada si el tokenizador no se puede cargar
 MODELO_OPENAI = "gpt-4o-mini"
+TEMPERATURA = 0.1
 
-CAMPOS_REQUERIDOS = {"nombre_cliente", "monto", "fecha", "tipo_solicitud"}
-TIPOS_VALIDOS = {"Venta", "Queja", "Factura"}
-EXTENSIONES_SOPORTADAS = {".txt", ".pdf", ".docx", ".xlsx", ".xls"}
+CACHE_TTL_DIAS = 30  # Vigencia de las respuestas guardadas en CACHE_DIR
+
+# Batch API: sondeo del estado del lote con backoff exponencial (segundos)
+SONDEO_LOTE_INICIAL = 10
+SONDEO_LOTE_MAXIMO = 600
+
+EXTENSIONES_SOPORTADAS = frozenset({".txt", ".pdf", ".docx", ".xlsx", ".xls"})
+
+# Etiquetas de WordprocessingML usadas al leer word/document.xml
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_W_P, _W_R, _W_T, _W_TAB = f"{_W}p", f"{_W}r", f"{_W}t", f"{_W}tab"
+_W_BR, _W_CR, _W_TR, _W_TC = f"{_W}br", f"{_W}cr", f"{_W}tr", f"{_W}tc"
+# mc:Fallback repite el contenido de mc:Choice (p. ej. cuadros de texto) para lectores antiguos
+_MC_FALLBACK = "{http://schemas.openxmlformats.org/markup-compatibility/2006}Fallback"
+
+# Validación rápida de fechas YYYY-MM-DD (evita el costo de datetime.strptime)
+_FECHA_RE = re.compile(r"(\d{4})-(\d{2})-(\d{2})", re.ASCII)
+# Números con separadores de miles/decimales ("12,180", "250,000.50", "1.234,56")
+_NUMERO_RE = re.compile(r"\d+(?:[.,]\d+)*", re.ASCII)
+
+# PDFs con al menos esta cantidad de páginas se reparten por rangos entre los procesos de lectura
+PAGINAS_PDF_PARALELO = 16
+
+# ── Esquema de salida ────────────────────────────────────────────────────────
+
+
+class Extraccion(msgspec.Struct, forbid_unknown_fields=True):
+    """Datos estructurados extraídos de un documento."""
+
+    nombre_cliente: str
+    monto: Union[int, float, None]
+    fecha: str
+    tipo_solicitud: Literal["Venta", "Queja", "Factura"]
+
+
+class LoteExtraccion(msgspec.Struct, forbid_unknown_fields=True):
+    """Respuesta de la IA: un registro por documento, en el mismo orden."""
+
+    documentos: list[Extraccion]
+
+
+def _esquema_lote() -> dict:
+    """Esquema JSON de LoteExtraccion con el objeto raíz en línea (requisito de OpenAI)."""
+    _, componentes = msgspec.json.schema_components(
+        [LoteExtraccion], ref_template="#/$defs/{name}"
+    )
+    raiz = componentes.pop("LoteExtraccion")
+    return {**raiz, "$defs": componentes}
+
+
+# Esquema que OpenAI impone a la respuesta (structured outputs)
+FORMATO_RESPUESTA = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "LoteExtraccion",
+        "strict": True,
+        "schema": _esquema_lote(),
+    },
+}
 
 # ── Logging ──────────────────────────────────────────────────────────────────
 
@@ -43,17 +125,31 @@ logging.basicConfig(
 )
 logger = logging.getLogger("PlanetaFiscal")
 
+# Caché semántica opcional (ver semantic_cache.py); se activa con --cache-semantica
+_cache_semantica = None
+
 # ── Prompt del sistema ───────────────────────────────────────────────────────
 
+# Incrementar al modificar SYSTEM_PROMPT para invalidar la caché.
+# El prompt es fijo y supera los 1024 tokens para que OpenAI reutilice su
+# caché de prefijos; el contenido variable va solo en el mensaje del usuario.
+PROMPT_VERSION = "v4"
+
 SYSTEM_PROMPT = """Eres un asistente experto en extracción de datos estructurados.
-Tu tarea es analizar texto desordenado (correos, facturas, quejas, solicitudes)
-y devolver EXCLUSIVAMENTE un objeto JSON válido con la siguiente estructura:
+Tu tarea es analizar uno o varios documentos con texto desordenado (correos,
+facturas, quejas, solicitudes). Cada documento empieza con una línea "---DOC N---".
+Debes devolver un objeto JSON cuyo campo "documentos" es un arreglo con un objeto
+por documento, en el mismo orden en que aparecen, con la siguiente estructura:
 
 {
-  "nombre_cliente": "string",
-  "monto": number | null,
-  "fecha": "YYYY-MM-DD",
-  "tipo_solicitud": "Venta | Queja | Factura"
+  "documentos": [
+    {
+      "nombre_cliente": "string",
+      "monto": number | null,
+      "fecha": "YYYY-MM-DD",
+      "tipo_solicitud": "Venta | Queja | Factura"
+    }
+  ]
 }
 
 Reglas estrictas:
@@ -62,25 +158,185 @@ Reglas estrictas:
 3. "fecha": Fecha más relevante del documento en formato YYYY-MM-DD. Si hay varias, usar la principal.
 4. "tipo_solicitud": SOLO puede ser "Venta", "Queja" o "Factura". Clasifica según el contenido.
 
+Definiciones de "tipo_solicitud":
+- "Venta": el cliente quiere comprar, cotizar, contratar o renovar un producto o
+  servicio. Incluye pedidos, solicitudes de cotización, órdenes de compra y
+  consultas de precio con intención de compra.
+- "Queja": el cliente expresa inconformidad con un producto, servicio, entrega,
+  cobro o atención. Incluye reclamos, solicitudes de reembolso o devolución y
+  reportes de fallas, aunque mencionen una venta o factura anterior.
+- "Factura": el documento es una factura, recibo, nota de cargo o solicitud de
+  emisión/corrección de factura, sin inconformidad del cliente. Incluye tablas
+  de conceptos con subtotal, impuestos y total.
+Si un documento encaja en varias categorías, prioriza: Queja > Factura > Venta.
+
+Criterios para "nombre_cliente":
+- Es quien envía o firma el documento, o la empresa a nombre de quien se solicita.
+- En facturas, usar el nombre del emisor o proveedor que aparece como remitente
+  si no se identifica otro cliente; conservar la razón social tal como aparece.
+- No incluir cargos, títulos ni saludos ("Lic.", "Atentamente", "Gerente de...")
+  salvo que formen parte de la razón social.
+
+Criterios para "monto":
+- Usar el total final (con impuestos) si aparece; si no, el monto principal.
+- Convertir expresiones como "15 mil", "$12,750.00" o "doce mil pesos" a número
+  (15000, 12750, 12000). Usar punto decimal y sin separadores de miles.
+- Si solo hay un monto estimado o aproximado, usarlo igualmente.
+- Si no se menciona ningún monto, usar null (nunca 0 ni un string).
+
+Criterios para "fecha":
+- Convertir cualquier formato ("8 de febrero de 2026", "14-02-2026", "14/02/26")
+  a YYYY-MM-DD. Las fechas numéricas se interpretan como día/mes/año.
+- Preferir la fecha de emisión del documento; si no existe, la fecha del hecho
+  principal (compra, entrega, incidente).
+- Si el documento no tiene año, usar el año de la fecha más cercana mencionada.
+
+Ejemplos (solo ilustrativos, no los repitas en la respuesta):
+
+---DOC 1---
+Buenas tardes, soy Andrea Villalobos de Grupo Altamar. Queremos cotizar 40
+licencias anuales del software contable. Nuestro presupuesto es de 38 mil pesos.
+Quedo atenta. 3 de marzo de 2026.
+
+---DOC 2---
+FACTURA No. A-1182
+Emisor: Distribuidora Norte S.A. de C.V.
+Fecha de emisión: 21/01/2026
+Subtotal: $10,500.00  IVA: $1,680.00  Total: $12,180.00
+
+---DOC 3---
+Les escribo muy molesto. Compré una impresora el 10 de enero y llegó dañada.
+Nadie me responde. Exijo una solución. Jorge Salinas.
+
+---DOC 4---
+--- Hoja: Pedido ---
+Cliente: | Ferretería El Roble |  |
+Fecha pedido: | 2026-02-18 |  |
+Producto | Cantidad | Precio | Importe
+Taladro industrial | 2 | 3200 | 6400
+Juego de brocas | 5 | 450 | 2250
+ |  | TOTAL: | 8650
+
+Respuesta esperada:
+{"documentos": [
+  {"nombre_cliente": "Grupo Altamar", "monto": 38000, "fecha": "2026-03-03", "tipo_solicitud": "Venta"},
+  {"nombre_cliente": "Distribuidora Norte S.A. de C.V.", "monto": 12180, "fecha": "2026-01-21", "tipo_solicitud": "Factura"},
+  {"nombre_cliente": "Jorge Salinas", "monto": null, "fecha": "2026-01-10", "tipo_solicitud": "Queja"},
+  {"nombre_cliente": "Ferretería El Roble", "monto": 8650, "fecha": "2026-02-18", "tipo_solicitud": "Venta"}
+]}
+
+Más ejemplos de clasificación:
+- "Solicito la corrección del RFC en la factura F-220 por $4,500" -> Factura, monto 4500.
+- "El cobro de $899 en mi tarjeta es incorrecto, quiero mi reembolso" -> Queja, monto 899.
+- "Nos interesa renovar el plan empresarial para 2026" (sin monto) -> Venta, monto null.
+- "Adjunto orden de compra OC-77 por 250,000.50 MXN" -> Venta, monto 250000.5.
+- "Recibo de pago de honorarios, total $7,200" -> Factura, monto 7200.
+
 IMPORTANTE:
-- Responde ÚNICAMENTE con el JSON. Sin texto adicional, sin explicaciones, sin markdown.
-- No envuelvas el JSON en bloques de código.
-- El JSON debe ser válido y parseable directamente.
+- El arreglo "documentos" debe tener exactamente un objeto por documento, aunque sea uno solo.
+- No omitas documentos aunque tengan poca información; usa null en "monto" si no hay monto.
+- No agregues campos adicionales ni texto fuera del JSON.
 """
 
 
+# ── Límite de tasa ───────────────────────────────────────────────────────────
+
+
+class LimitadorTasa:
+    """
+    Cubeta de tokens que mantiene las peticiones por debajo de los límites de
+    la cuenta (peticiones y tokens por minuto). Ambas capacidades se recargan
+    de forma continua; cada petición espera hasta que haya capacidad para ella.
+    Basado en api_request_parallel_processor.py del OpenAI Cookbook.
+    """
+
+    def __init__(self, max_peticiones_minuto: float, max_tokens_minuto: float):
+        self.max_peticiones = max_peticiones_minuto
+        self.max_tokens = max_tokens_minuto
+        self._peticiones_disponibles = max_peticiones_minuto
+        self._tokens_disponibles = max_tokens_minuto
+        self._ultima_recarga = time.monotonic()
+        self._pausa_hasta = 0.0
+        self._lock = asyncio.Lock()
+
+    def _recargar(self) -> None:
+        """Recarga la capacidad proporcional al tiempo transcurrido."""
+        ahora = time.monotonic()
+        transcurrido = ahora - self._ultima_recarga
+        self._ultima_recarga = ahora
+        self._peticiones_disponibles = min(
+            self.max_peticiones,
+            self._peticiones_disponibles + transcurrido * self.max_peticiones / 60,
+        )
+        self._tokens_disponibles = min(
+            self.max_tokens,
+            self._tokens_disponibles + transcurrido * self.max_tokens / 60,
+        )
+
+    async def adquirir(self, tokens: int) -> None:
+        """Espera hasta poder enviar una petición que consume `tokens` tokens."""
+        # Una petición mayor que el límite por minuto nunca cabría en la cubeta
+        tokens = min(tokens, self.max_tokens)
+
+        # El lock atiende las peticiones en orden de llegada
+        async with self._lock:
+            while True:
+                pausa = self._pausa_hasta - time.monotonic()
+                if pausa > 0:
+                    await asyncio.sleep(pausa)
+                    continue
+
+                self._recargar()
+                if self._peticiones_disponibles >= 1 and self._tokens_disponibles >= tokens:
+                    self._peticiones_disponibles -= 1
+                    self._tokens_disponibles -= tokens
+                    return
+
+                await asyncio.sleep(max(
+                    (1 - self._peticiones_disponibles) * 60 / self.max_peticiones,
+                    (tokens - self._tokens_disponibles) * 60 / self.max_tokens,
+                ))
+
+    def pausar(self, segundos: float) -> None:
+        """Detiene todas las peticiones durante `segundos` (p. ej. tras un error 429)."""
+        self._pausa_hasta = max(self._pausa_hasta, time.monotonic() + segundos)
+
+
+async def crear_limitador(cliente: AsyncOpenAI) -> LimitadorTasa:
+    """
+    Detecta los límites de la cuenta con una petición de 1 token (leyendo los
+    encabezados x-ratelimit-limit-*) y crea el limitador con un margen de
+    seguridad. Si la detección falla, usa RPM_POR_DEFECTO y TPM_POR_DEFECTO.
+    """
+    rpm, tpm = RPM_POR_DEFECTO, TPM_POR_DEFECTO
+    try:
+        respuesta = await cliente.chat.completions.with_raw_response.create(
+            model=MODELO_OPENAI,
+            messages=[{"role": "user", "content": "ok"}],
+            max_tokens=1,
+        )
+        rpm = int(respuesta.headers.get("x-ratelimit-limit-requests", rpm))
+        tpm = int(respuesta.headers.get("x-ratelimit-limit-tokens", tpm))
+    except Exception as e:
+        logger.warning(f"No se pudieron detectar los límites de la cuenta ({e}); se usan los valores por defecto.")
+
+    logger.info(f"Límites de la cuenta: {rpm} peticiones/min, {tpm} tokens/min.")
+    return LimitadorTasa(rpm * FRACCION_LIMITES, tpm * FRACCION_LIMITES)
+
+
 # ── Funciones principales ────────────────────────────────────────────────────
 
 
-def crear_cliente_openai() -> OpenAI:
-    """Crea y retorna un cliente de OpenAI validando que la API key exista."""
+def crear_cliente_openai() -> AsyncOpenAI:
+    """Crea y retorna un cliente asíncrono de OpenAI validando que la API key exista."""
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key or api_key == "sk-tu-api-key-aqui":
         raise EnvironmentError(
             "OPENAI_API_KEY no configurada. "
             "Edita el archivo .env con tu API key válida."
         )
-    return OpenAI(api_key=api_key)
+    # Sin reintentos del SDK: extraer_datos ya reintenta con backoff y jitter
+    return AsyncOpenAI(api_key=api_key, max_retries=0)
 
 
 def leer_archivo(ruta: Path) -> str:
@@ -113,31 +369,121 @@ def _leer_txt(ruta: Path) -> str:
     raise ValueError(f"No se pudo decodificar el archivo: {ruta}")
 
 
+def _extraer_paginas_pdf(ruta: Path, inicio: int, fin: int) -> list[str]:
+    """Extrae con PDFium el texto de las páginas [inicio, fin) de un PDF."""
+    pdf = pdfium.PdfDocument(ruta)
+    try:
+        return [
+            pdf[i].get_textpage().get_text_range().replace("\r\n", "\n")
+            for i in range(inicio, fin)
+        ]
+    finally:
+        pdf.close()
+
+
+def _contar_paginas_pdf(ruta: Path) -> int:
+    """Retorna el número de páginas de un PDF (ValueError si PDFium no lo puede abrir)."""
+    try:
+        pdf = pdfium.PdfDocument(ruta)
+    except pdfium.PdfiumError as e:
+        raise ValueError(f"No se pudo abrir el PDF {ruta.name}: {e}")
+    try:
+        return len(pdf)
+    finally:
+        pdf.close()
+
+
 def _leer_pdf(ruta: Path) -> str:
-    """Extrae todo el texto de un archivo PDF."""
+    """
+    Extrae todo el texto de un archivo PDF con PDFium (pypdfium2).
+    Si PDFium no obtiene texto, se intenta con pdfplumber.
+    """
+    return _unir_paginas_pdf(ruta, _extraer_paginas_pdf(ruta, 0, _contar_paginas_pdf(ruta)))
+
+
+def _unir_paginas_pdf(ruta: Path, texto_paginas: list[str]) -> str:
+    """Une el texto de las páginas de un PDF; si está vacío, recurre a pdfplumber."""
+    contenido = "\n".join(t for t in texto_paginas if t.strip())
+    if not contenido.strip():
+        contenido = _leer_pdf_pdfplumber(ruta)
+    if not contenido.strip():
+        raise ValueError(f"El PDF no contiene texto extraíble: {ruta.name}")
+    return contenido
+
+
+def _leer_pdf_pdfplumber(ruta: Path) -> str:
+    """Extrae el texto de un PDF con pdfplumber (respaldo, más lento)."""
     texto_paginas = []
     with pdfplumber.open(ruta) as pdf:
         for pagina in pdf.pages:
             texto = pagina.extract_text()
             if texto:
                 texto_paginas.append(texto)
-    contenido = "\n".join(texto_paginas)
-    if not contenido.strip():
-        raise ValueError(f"El PDF no contiene texto extraíble: {ruta.name}")
-    return contenido
+    return "\n".join(texto_paginas)
 
 
 def _leer_docx(ruta: Path) -> str:
-    """Extrae todo el texto de un archivo Word (.docx)."""
-    doc = Document(ruta)
-    parrafos = [p.text for p in doc.paragraphs if p.text.strip()]
+    """
+    Extrae todo el texto de un archivo Word (.docx) en una sola pasada por
+    word/document.xml, en el orden del documento. Los párrafos se devuelven
+    como líneas y cada fila de tabla como "celda | celda".
+    """
+    parrafos = []
+    fragmentos = [[]]  # Pila: texto de cada párrafo abierto (cuadros de texto anidan w:p)
+    celdas_por_fila = []  # Pila: celdas de cada fila abierta (tablas anidadas)
+    parrafos_por_celda = []  # Pila: párrafos de cada celda abierta
+    en_run = 0  # Solo se toma el texto dentro de <w:r> (w:tab también define tabulaciones)
+    en_fallback = 0  # Dentro de mc:Fallback todo es copia de mc:Choice: se omite
 
-    # También extraer texto de tablas
-    for tabla in doc.tables:
-        for fila in tabla.rows:
-            celdas = [c.text.strip() for c in fila.cells if c.text.strip()]
-            if celdas:
-                parrafos.append(" | ".join(celdas))
+    try:
+        with zipfile.ZipFile(ruta) as z, z.open("word/document.xml") as f:
+            for evento, el in ET.iterparse(f, events=("start", "end")):
+                tag = el.tag
+                if tag == _MC_FALLBACK:
+                    en_fallback += 1 if evento == "start" else -1
+                    continue
+                if en_fallback:
+                    continue
+
+                if evento == "start":
+                    if tag == _W_R:
+                        en_run += 1
+                    elif tag == _W_P:
+                        fragmentos.append([])
+                    elif tag == _W_TR:
+                        celdas_por_fila.append([])
+                    elif tag == _W_TC:
+                        parrafos_por_celda.append([])
+                    continue
+
+                if tag == _W_R:
+                    en_run -= 1
+                elif en_run and tag == _W_T:
+                    fragmentos[-1].append(el.text or "")
+                elif en_run and tag == _W_TAB:
+                    fragmentos[-1].append("\t")
+                elif en_run and tag in (_W_BR, _W_CR):
+                    fragmentos[-1].append("\n")
+                elif tag == _W_P:
+                    texto = "".join(fragmentos.pop())
+                    if parrafos_por_celda:
+                        parrafos_por_celda[-1].append(texto)
+                    elif texto.strip():
+                        parrafos.append(texto)
+                    el.clear()
+                elif tag == _W_TC:
+                    texto = "\n".join(parrafos_por_celda.pop()).strip()
+                    if texto:
+                        celdas_por_fila[-1].append(texto)
+                elif tag == _W_TR:
+                    celdas = celdas_por_fila.pop()
+                    if celdas:
+                        # Fila de una tabla anidada: forma parte de la celda que la contiene
+                        destino = parrafos_por_celda[-1] if parrafos_por_celda else parrafos
+                        destino.append(" | ".join(celdas))
+                    el.clear()
+    except (zipfile.BadZipFile, KeyError, ET.ParseError) as e:
+        raise ValueError(f"No se pudo leer el documento Word {ruta.name}: {e}")
 
     contenido = "\n".join(parrafos)
     if not contenido.strip():
@@ -145,134 +491,748 @@ def _leer_docx(ruta: Path) -> str:
     return contenido
 
 
+def _valor_celda(valor) -> str:
+    """Convierte una celda a texto; los números enteros se muestran sin decimales."""
+    if isinstance(valor, float) and valor.is_integer():
+        return str(int(valor))
+    return str(valor)
+
+
 def _leer_excel(ruta: Path) -> str:
-    """Extrae todo el texto de un archivo Excel (.xlsx/.xls)."""
-    wb = openpyxl.load_workbook(ruta, read_only=True, data_only=True)
+    """
+    Extrae todo el texto de un archivo Excel (.xlsx/.xls) con calamine.
+    Las filas se recorren en streaming dentro del rango usado de cada hoja.
+    """
     lineas = []
 
-    for hoja in wb.sheetnames:
-        ws = wb[hoja]
-        lineas.append(f"--- Hoja: {hoja} ---")
-        for fila in ws.iter_rows(values_only=True):
-            valores = [str(v) if v is not None else "" for v in fila]
-            linea = " | ".join(valores)
-            if linea.strip(" |"):
-                lineas.append(linea)
+    try:
+        with CalamineWorkbook.from_path(str(ruta)) as wb:
+            for hoja in wb.sheet_names:
+                lineas.append(f"--- Hoja: {hoja} ---")
+                for fila in wb.get_sheet_by_name(hoja).iter_rows():
+                    # Las celdas vacías llegan como "": descartar filas vacías sin armar la línea
+                    if all(v == "" for v in fila):
+                        continue
+                    lineas.append(" | ".join(map(_valor_celda, fila)))
+    except CalamineError as e:
+        raise ValueError(f"No se pudo leer el archivo Excel {ruta.name}: {e}")
 
-    wb.close()
     contenido = "\n".join(lineas)
     if not contenido.strip():
         raise ValueError(f"El archivo Excel está vacío: {ruta.name}")
     return contenido
 
 
-def validar_json(respuesta_texto: str) -> dict:
+def validar_json(respuesta_texto: str, cantidad: int = 1) -> list[dict]:
     """
-    Valida que la respuesta sea un JSON válido con todos los campos requeridos
-    y tipos correctos. Lanza ValueError si la validación falla.
+    Decodifica y valida en una sola pasada (msgspec) una respuesta JSON de la
+    IA contra el esquema LoteExtraccion y retorna los registros validados.
+    Lanza ValueError si la validación falla.
     """
-    # Limpiar posibles envolturas de markdown
-    texto = respuesta_texto.strip()
-    if texto.startswith("```"):
-        lineas = texto.split("\n")
-        lineas = [l for l in lineas if not l.strip().startswith("```")]
-        texto = "\n".join(lineas).strip()
+    try:
+        lote = msgspec.json.decode(respuesta_texto, type=LoteExtraccion)
+    except msgspec.DecodeError as e:
+        raise ValueError(f"La respuesta no cumple el esquema: {e}")
+    return validar_lote(lote, cantidad)
 
-    # Parsear JSON
+
+def validar_lote(lote: LoteExtraccion, cantidad: int) -> list[dict]:
+    """
+    Valida que el lote tenga `cantidad` registros y que cada uno pase las
+    reglas que el esquema no puede expresar. Lanza ValueError si falla.
+    """
+    if len(lote.documentos) != cantidad:
+        raise ValueError(
+            f"Se esperaban {cantidad} registro(s) en 'documentos', "
+            f"se recibieron {len(lote.documentos)}."
+        )
+    return [_validar_extraccion(registro) for registro in lote.documentos]
+
+
+def validar_registro(datos) -> dict:
+    """
+    Valida que un registro (p. ej. leído de la caché) tenga todos los campos
+    requeridos y tipos correctos. Lanza ValueError si la validación falla.
+    """
     try:
-        datos = json.loads(texto)
-    except json.JSONDecodeError as e:
-        raise ValueError(f"Respuesta no es JSON válido: {e}")
-
-    # Si la IA devuelve una lista (múltiples registros), tomar el primero
-    if isinstance(datos, list):
-        if len(datos) == 0:
-            raise ValueError("La IA devolvió una lista vacía.")
-        datos = datos[0]
-
-    # Verificar que sea un diccionario
-    if not isinstance(datos, dict):
-        raise ValueError(f"Se esperaba un objeto JSON, se recibió: {type(datos).__name__}")
-
-    # Verificar campos requeridos
-    campos_faltantes = CAMPOS_REQUERIDOS - set(datos.keys())
-    if campos_faltantes:
-        raise ValueError(f"Campos faltantes en el JSON: {campos_faltantes}")
-
-    # Validar tipos
-    if not isinstance(datos["nombre_cliente"], str) or not datos["nombre_cliente"].strip():
+        registro = msgspec.convert(datos, type=Extraccion)
+    except msgspec.ValidationError as e:
+        raise ValueError(f"Registro inválido: {e}")
+    return _validar_extraccion(registro)
+
+
+def _validar_extraccion(registro: Extraccion) -> dict:
+    """
+    Comprueba las reglas que el esquema JSON no impone (nombre no vacío y
+    fecha existente en formato YYYY-MM-DD) y retorna el registro como dict.
+    """
+    nombre = registro.nombre_cliente
+    if not nombre or nombre.isspace():
         raise ValueError("'nombre_cliente' debe ser un string no vacío.")
 
-    if datos["monto"] is not None:
-        if not isinstance(datos["monto"], (int, float)):
-            raise ValueError(f"'monto' debe ser numérico o null, se recibió: {type(datos['monto']).__name__}")
+    fecha = registro.fecha
+    coincidencia = _FECHA_RE.fullmatch(fecha)
+    if not coincidencia:
+        raise ValueError(f"'fecha' no tiene formato YYYY-MM-DD válido: {fecha}")
+    anio, mes, dia = map(int, coincidencia.groups())
+    if not (anio >= 1 and 1 <= mes <= 12 and 1 <= dia <= 31):
+        raise ValueError(f"'fecha' no tiene formato YYYY-MM-DD válido: {fecha}")
+    if dia > 28:  # Hasta el día 28 existe en todos los meses
+        try:
+            datetime(anio, mes, dia)  # Rechaza días inexistentes (p. ej. 30 de febrero)
+        except ValueError:
+            raise ValueError(f"'fecha' no tiene formato YYYY-MM-DD válido: {fecha}")
+
+    return msgspec.structs.asdict(registro)
+
 
-    if not isinstance(datos["fecha"], str):
-        raise ValueError("'fecha' debe ser un string en formato YYYY-MM-DD.")
+def _ruta_cache(texto: str) -> Path:
+    """Ruta del archivo de caché para un texto, según modelo, prompt y contenido."""
+    clave = hashlib.sha256(
+        f"{MODELO_OPENAI}|{PROMPT_VERSION}|{texto}".encode("utf-8")
+    ).hexdigest()
+    return CACHE_DIR / f"{clave}.json"
+
+
+async def leer_cache(texto: str) -> Optional[dict]:
+    """
+    Retorna los datos guardados para el texto, o None si no hay acierto.
+    Consulta primero la caché exacta y, si está activa, la caché semántica;
+    un acierto semántico solo se acepta si su cliente y monto aparecen en el texto.
+    """
+    datos = _leer_cache_exacta(texto)
+    if datos is not None or _cache_semantica is None:
+        return datos
+
+    datos = await _cache_semantica.buscar(texto)
+    if datos is None:
+        return None
     try:
-        datetime.strptime(datos["fecha"], "%Y-%m-%d")
+        datos = validar_registro(datos)
     except ValueError:
-        raise ValueError(f"'fecha' no tiene formato YYYY-MM-DD válido: {datos['fecha']}")
+        return None
+    if not _aparece_en_texto(datos, texto):
+        logger.debug("  Acierto semántico descartado: el cliente o el monto no aparecen en el texto.")
+        return None
+    return datos
 
-    if datos["tipo_solicitud"] not in TIPOS_VALIDOS:
-        raise ValueError(
-            f"'tipo_solicitud' inválido: '{datos['tipo_solicitud']}'. "
-            f"Valores permitidos: {TIPOS_VALIDOS}"
-        )
 
-    return datos
+def _aparece_en_texto(datos: dict, texto: str) -> bool:
+    """
+    Comprueba que el nombre del cliente y el monto de unos datos guardados
+    aparezcan en el texto (una misma plantilla con otro cliente o monto es
+    casi idéntica para los embeddings).
+    """
+    nombre = " ".join(datos["nombre_cliente"].split()).casefold()
+    if nombre not in " ".join(texto.split()).casefold():
+        return False
+
+    monto = datos["monto"]
+    if monto is None:
+        return True
+    for numero in _NUMERO_RE.findall(texto):
+        # Se prueban ambas convenciones: 1,234.56 y 1.234,56
+        for candidato in (numero.replace(",", ""), numero.replace(".", "").replace(",", ".")):
+            try:
+                if abs(float(candidato) - monto) < 0.005:
+                    return True
+            except ValueError:
+                pass
+    return False
+
+
+def _leer_cache_exacta(texto: str) -> Optional[dict]:
+    """
+    Retorna los datos guardados en disco para el texto, o None si no existen
+    o expiraron. Las entradas que ya no pasan la validación se eliminan.
+    """
+    ruta = _ruta_cache(texto)
+    try:
+        entrada = orjson.loads(ruta.read_bytes())
+    except FileNotFoundError:
+        return None
+    except (OSError, orjson.JSONDecodeError):
+        ruta.unlink(missing_ok=True)
+        return None
+
+    try:
+        if datetime.fromisoformat(entrada["expira_en"]) <= datetime.now(timezone.utc):
+            ruta.unlink(missing_ok=True)
+            return None
+        return validar_registro(entrada["datos"])
+    except (KeyError, TypeError, ValueError):
+        # Entrada con otro formato (p. ej. sin expira_en, o no es un objeto JSON)
+        ruta.unlink(missing_ok=True)
+        return None
+
+
+async def guardar_cache(texto: str, datos: dict) -> None:
+    """Guarda los datos extraídos de un texto en la caché de disco (y en la semántica, si está activa)."""
+    if _cache_semantica is not None:
+        await _cache_semantica.agregar(texto, datos)
+
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    ruta = _ruta_cache(texto)
+    ahora = datetime.now(timezone.utc)
+    entrada = {
+        "hash_texto": ruta.stem,
+        "modelo": MODELO_OPENAI,
+        "version_prompt": PROMPT_VERSION,
+        "creado_en": ahora.isoformat(),
+        "expira_en": (ahora + timedelta(days=CACHE_TTL_DIAS)).isoformat(),
+        "datos": datos,
+    }
+    ruta.write_bytes(orjson.dumps(entrada, option=orjson.OPT_INDENT_2))
+
+
+@functools.lru_cache(maxsize=1)
+def _codificador() -> Optional[tiktoken.Encoding]:
+    """
+    Tokenizador del modelo configurado (o200k_base si tiktoken no lo conoce).
+    Retorna None si no se puede cargar (p. ej. sin red para descargar el
+    vocabulario); en ese caso los tokens se aproximan por caracteres.
+    """
+    try:
+        try:
+            return tiktoken.encoding_for_model(MODELO_OPENAI)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except (OSError, ValueError) as e:
+        logger.warning(f"No se pudo cargar el tokenizador ({e}); se estimarán los tokens por caracteres.")
+        return None
 
 
-def extraer_datos(cliente: OpenAI, texto: str) -> dict:
+def _truncar_texto(texto: str) -> str:
     """
-    Envía el texto a OpenAI y extrae datos estructurados.
-    Reintenta hasta MAX_REINTENTOS veces si la respuesta es inválida.
+    Recorta el texto a MAX_TOKENS_TEXTO tokens conservando el inicio y el
+    final del documento (en las facturas el total suele estar al final).
+    """
+    # Un token casi siempre ocupa al menos un carácter: los textos cortos no se tokenizan
+    if len(texto) <= MAX_TOKENS_TEXTO:
+        return texto
+
+    codificador = _codificador()
+    if codificador is None:
+        inicio = int(MAX_TOKENS_TEXTO * PROPORCION_INICIO) * CARACTERES_POR_TOKEN
+        fin = MAX_TOKENS_TEXTO * CARACTERES_POR_TOKEN - inicio
+        if len(texto) <= inicio + fin:
+            return texto
+        return texto[:inicio] + "\n[...]\n" + texto[-fin:]
+
+    tokens = codificador.encode(texto, disallowed_special=())
+    if len(tokens) <= MAX_TOKENS_TEXTO:
+        return texto
+
+    inicio = int(MAX_TOKENS_TEXTO * PROPORCION_INICIO)
+    fin = MAX_TOKENS_TEXTO - inicio
+    logger.debug(f"  Texto recortado de {len(tokens)} a {MAX_TOKENS_TEXTO} tokens.")
+    return (
+        codificador.decode(tokens[:inicio])
+        + "\n[...]\n"
+        + codificador.decode(tokens[-fin:])
+    )
+
+
+@functools.lru_cache(maxsize=1)
+def _tokens_prompt_sistema() -> int:
+    """Tokens de SYSTEM_PROMPT (fijo, se cuenta una sola vez)."""
+    return _contar_tokens(SYSTEM_PROMPT)
+
+
+def _contar_tokens(texto: str) -> int:
+    """Cuenta los tokens de un texto, o los aproxima si no hay tokenizador."""
+    codificador = _codificador()
+    if codificador is None:
+        return len(texto) // CARACTERES_POR_TOKEN
+    return len(codificador.encode(texto, disallowed_special=()))
+
+
+def _tokens_estimados(mensajes: list[dict], documentos: int) -> int:
+    """Estima los tokens que consumirá una petición: prompt más respuesta esperada."""
+    total = documentos * TOKENS_RESPUESTA_POR_DOC
+    for mensaje in mensajes:
+        contenido = mensaje["content"]
+        if contenido is SYSTEM_PROMPT:
+            total += _tokens_prompt_sistema()
+        else:
+            total += _contar_tokens(contenido)
+    return total
+
+
+def construir_mensajes(textos: list[str]) -> list[dict]:
     """
+    Construye los mensajes del chat para extraer los datos de uno o varios
+    textos en una sola petición, delimitados con "---DOC N---".
+    Los textos largos se recortan a MAX_TOKENS_TEXTO tokens.
+    """
+    documentos = "\n\n".join(
+        f"---DOC {i}---\n{_truncar_texto(texto)}" for i, texto in enumerate(textos, start=1)
+    )
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {
+            "role": "user",
+            "content": (
+                f"Extrae los datos de los siguientes {len(textos)} documento(s). "
+                f"Responde con un registro por documento en el mismo orden.\n\n{documentos}"
+            ),
+        },
+    ]
+
+
+def _registrar_uso(respuesta, nombre: str) -> None:
+    """Registra cuántos tokens del prompt se sirvieron desde la caché de OpenAI."""
+    uso = respuesta.usage
+    if uso is None:
+        return
+    detalles = uso.prompt_tokens_details
+    en_cache = (detalles.cached_tokens or 0) if detalles else 0
+    logger.debug(f"  [{nombre}] Tokens de prompt: {uso.prompt_tokens} ({en_cache} en caché)")
+
+
+def _segundos_retry_after(error: APIStatusError) -> Optional[float]:
+    """Segundos de espera indicados por la API (retry-after-ms / retry-after), si los hay."""
+    encabezados = error.response.headers
+    try:
+        if "retry-after-ms" in encabezados:
+            return float(encabezados["retry-after-ms"]) / 1000
+        if "retry-after" in encabezados:
+            return float(encabezados["retry-after"])
+    except ValueError:
+        pass  # Retry-After como fecha HTTP: usar el backoff propio
+    return None
+
+
+async def extraer_datos(
+    cliente: AsyncOpenAI,
+    textos: list[str],
+    nombre: str = "",
+    limitador: Optional[LimitadorTasa] = None,
+) -> list[dict]:
+    """
+    Envía los textos a OpenAI en una sola petición y extrae los datos
+    estructurados de cada uno, en el mismo orden.
+    Reintenta hasta MAX_REINTENTOS veces si la respuesta es inválida; en cada
+    reintento se envía a la IA su respuesta anterior y el error encontrado
+    para que lo corrija. Con un limitador, cada intento espera capacidad
+    disponible y un error 429 pausa todas las peticiones.
+    """
+    # La conversación se conserva entre intentos para incluir la retroalimentación
+    mensajes = construir_mensajes(textos)
+
     for intento in range(1, MAX_REINTENTOS + 1):
-        logger.info(f"  Intento {intento}/{MAX_REINTENTOS}...")
+        logger.info(f"  [{nombre}] Intento {intento}/{MAX_REINTENTOS}...")
+        texto_respuesta = ""
+        # Fuera del try: un fallo al estimar no debe reportarse como error de API
+        tokens = _tokens_estimados(mensajes, len(textos)) if limitador is not None else 0
 
         try:
-            respuesta = cliente.chat.completions.create(
+            if limitador is not None:
+                await limitador.adquirir(tokens)
+
+            # Structured outputs: la API garantiza que la respuesta cumple LoteExtraccion
+            respuesta = await cliente.chat.completions.create(
                 model=MODELO_OPENAI,
-                temperature=0.1,
-                messages=[
-                    {"role": "system", "content": SYSTEM_PROMPT},
-                    {"role": "user", "content": f"Extrae los datos del siguiente texto:\n\n{texto}"},
-                ],
+                temperature=TEMPERATURA,
+                messages=mensajes,
+                response_format=FORMATO_RESPUESTA,
             )
 
-            texto_respuesta = respuesta.choices[0].message.content
-            logger.debug(f"  Respuesta cruda: {texto_respuesta}")
+            mensaje = respuesta.choices[0].message
+            texto_respuesta = mensaje.content or ""
+            logger.debug(f"  [{nombre}] Respuesta cruda: {texto_respuesta}")
+            _registrar_uso(respuesta, nombre)
 
-            datos = validar_json(texto_respuesta)
-            logger.info(f"  JSON válido extraído exitosamente.")
+            if mensaje.refusal:
+                raise ValueError(f"La IA rechazó la solicitud: {mensaje.refusal}")
+            datos = validar_json(texto_respuesta, len(textos))
+            logger.info(f"  [{nombre}] JSON válido extraído exitosamente.")
             return datos
 
         except ValueError as e:
-            logger.warning(f"  Validación fallida: {e}")
+            logger.warning(f"  [{nombre}] Validación fallida: {e}")
             if intento == MAX_REINTENTOS:
                 raise RuntimeError(
                     f"Falló la extracción después de {MAX_REINTENTOS} intentos. "
                     f"Último error: {e}"
                 )
+            mensajes += [
+                {"role": "assistant", "content": texto_respuesta},
+                {
+                    "role": "user",
+                    "content": (
+                        f"Tu salida tuvo este error: {e}. "
+                        "Corrígelo y responde SOLO con el JSON válido."
+                    ),
+                },
+            ]
+            await asyncio.sleep(1.0 * intento)
+
+        except RateLimitError as e:
+            logger.warning(f"  [{nombre}] Límite de tasa excedido (429): {e}")
+            if intento == MAX_REINTENTOS:
+                raise RuntimeError(
+                    f"Límite de tasa excedido después de {MAX_REINTENTOS} intentos: {e}"
+                )
+            # Respetar Retry-After si la API lo indica; el jitter evita que las
+            # tareas concurrentes reintenten todas al mismo tiempo
+            espera = _segundos_retry_after(e) or ESPERA_LIMITE_TASA * 2 ** (intento - 1)
+            espera += random.random()
+            if limitador is not None:
+                limitador.pausar(espera)
+            else:
+                await asyncio.sleep(espera)
 
         except Exception as e:
-            logger.error(f"  Error de API: {e}")
+            logger.error(f"  [{nombre}] Error de API: {e}")
             if intento == MAX_REINTENTOS:
                 raise RuntimeError(
                     f"Error de API después de {MAX_REINTENTOS} intentos: {e}"
                 )
+            # Errores transitorios (5xx, red): backoff exponencial corto con jitter
+            await asyncio.sleep(2 ** intento + random.random())
 
     # Nunca debería llegar aquí
     raise RuntimeError("Error inesperado en extraer_datos.")
 
 
-def procesar_archivos() -> list[dict]:
+async def _procesar_grupo(
+    cliente: AsyncOpenAI,
+    semaforo: asyncio.Semaphore,
+    limitador: LimitadorTasa,
+    grupo: list[tuple[Path, str]],
+) -> tuple[list[dict], list[dict]]:
+    """
+    Extrae en una sola petición los datos de un grupo de archivos ya leídos,
+    limitando las peticiones simultáneas con el semáforo y la tasa de envío
+    con el limitador.
+    Si la extracción de un grupo de varios documentos falla, cada documento
+    se reintenta en su propia petición para que un archivo problemático no
+    haga fallar a los demás. Retorna (resultados, errores).
+    """
+    nombre = ", ".join(archivo.name for archivo, _ in grupo)
+    try:
+        async with semaforo:
+            logger.info(f"Procesando: {nombre}")
+            lista_datos = await extraer_datos(
+                cliente, [texto for _, texto in grupo], nombre, limitador
+            )
+    except RuntimeError as e:
+        if len(grupo) == 1:
+            archivo = grupo[0][0]
+            logger.error(f"  [{archivo.name}] ERROR FATAL: {e}")
+            return [], [{"archivo": archivo.name, "error": str(e)}]
+
+        logger.warning(f"  [{nombre}] Falló el grupo; se reintenta cada documento por separado.")
+        resultados, errores = [], []
+        for res, err in await asyncio.gather(
+            *(_procesar_grupo(cliente, semaforo, limitador, [par]) for par in grupo)
+        ):
+            resultados += res
+            errores += err
+        return resultados, errores
+
+    resultados = []
+    for (archivo, texto), datos in zip(grupo, lista_datos):
+        await guardar_cache(texto, datos)
+        resultados.append(_guardar_resultado(archivo, datos))
+    return resultados, []
+
+
+async def _leer_pdf_en_pool(
+    loop: asyncio.AbstractEventLoop, pool: ProcessPoolExecutor, procesos: int, ruta: Path
+) -> str:
+    """
+    Lee un PDF en el pool de lectura. Los PDFs con al menos PAGINAS_PDF_PARALELO
+    páginas se reparten por rangos de páginas entre los procesos del pool.
+    """
+    total = await loop.run_in_executor(pool, _contar_paginas_pdf, ruta)
+    if total < PAGINAS_PDF_PARALELO or procesos == 1:
+        return await loop.run_in_executor(pool, _leer_pdf, ruta)
+
+    tamano = -(-total // procesos)  # División hacia arriba
+    bloques = await asyncio.gather(*(
+        loop.run_in_executor(pool, _extraer_paginas_pdf, ruta, inicio, min(inicio + tamano, total))
+        for inicio in range(0, total, tamano)
+    ))
+    texto_paginas = [texto for bloque in bloques for texto in bloque]
+    if any(texto.strip() for texto in texto_paginas):
+        return _unir_paginas_pdf(ruta, texto_paginas)
+    # Sin texto de PDFium (p. ej. PDF escaneado): el respaldo con pdfplumber también va al pool
+    return await loop.run_in_executor(pool, _unir_paginas_pdf, ruta, [])
+
+
+async def _leer_pendientes(
+    archivos: list[Path], resultados: list[dict], errores: list[dict]
+) -> AsyncIterator[tuple[Path, str]]:
+    """
+    Lee los archivos en paralelo en un pool de procesos (el análisis de
+    PDF/Word/Excel usa CPU) y entrega los pares (archivo, texto) pendientes de
+    enviar a OpenAI a medida que terminan, para que las peticiones empiecen
+    mientras se siguen leyendo los demás archivos.
+    Los aciertos de caché se agregan a `resultados` y los errores de lectura
+    a `errores`.
+    """
+    loop = asyncio.get_running_loop()
+    procesos = os.cpu_count() or 1
+    # Un PDF largo se reparte entre todos los procesos aunque haya pocos archivos
+    if not any(archivo.suffix.lower() == ".pdf" for archivo in archivos):
+        procesos = min(procesos, len(archivos))
+
+    with ProcessPoolExecutor(max_workers=procesos) as pool:
+
+        async def leer(archivo: Path):
+            try:
+                if archivo.suffix.lower() == ".pdf":
+                    return archivo, await _leer_pdf_en_pool(loop, pool, procesos, archivo)
+                return archivo, await loop.run_in_executor(pool, leer_archivo, archivo)
+            except (ValueError, OSError) as e:
+                return archivo, e
+
+        for siguiente in asyncio.as_completed([leer(archivo) for archivo in archivos]):
+            archivo, texto = await siguiente
+            if isinstance(texto, Exception):
+                logger.error(f"  [{archivo.name}] ERROR FATAL: {texto}")
+                errores.append({"archivo": archivo.name, "error": str(texto)})
+            elif (datos := await leer_cache(texto)) is not None:
+                logger.info(f"  [{archivo.name}] Datos obtenidos de la caché.")
+                resultados.append(_guardar_resultado(archivo, datos))
+            else:
+                yield archivo, texto
+
+
+def _ruta_resultado(archivo: Path) -> Path:
+    """Ruta del JSON individual de resultados de un archivo."""
+    return OUTPUT_DIR / f"{archivo.stem}_resultado.json"
+
+
+def _omitir_procesados(archivos: list[Path]) -> tuple[list[Path], list[dict]]:
+    """
+    Separa los archivos que ya tienen un JSON de resultados válido en
+    OUTPUT_DIR de una ejecución anterior. Retorna los archivos pendientes
+    y las entradas del resumen de los ya procesados.
+    """
+    pendientes = []
+    previos = []
+
+    for archivo in archivos:
+        salida_individual = _ruta_resultado(archivo)
+        try:
+            datos = validar_registro(orjson.loads(salida_individual.read_bytes()))
+        except (OSError, ValueError):
+            # Sin resultado previo (o inválido): se procesa de nuevo
+            pendientes.append(archivo)
+            continue
+
+        logger.info(f"  [{archivo.name}] Ya procesado: {salida_individual.name}")
+        previos.append({
+            "archivo_origen": archivo.name,
+            "datos_extraidos": datos,
+            "procesado_en": datetime.fromtimestamp(salida_individual.stat().st_mtime).isoformat(),
+        })
+
+    return pendientes, previos
+
+
+def _guardar_resultado(archivo: Path, datos: dict) -> dict:
+    """Guarda el JSON individual de un archivo y retorna su entrada del resumen."""
+    salida_individual = _ruta_resultado(archivo)
+    salida_individual.write_bytes(orjson.dumps(datos, option=orjson.OPT_INDENT_2))
+    logger.info(f"  [{archivo.name}] Guardado: {salida_individual.name}")
+
+    return {
+        "archivo_origen": archivo.name,
+        "datos_extraidos": datos,
+        "procesado_en": datetime.now().isoformat(),
+    }
+
+
+async def _esperar_lote(cliente: AsyncOpenAI, lote_id: str):
+    """
+    Consulta el estado de un lote de la Batch API hasta que termine,
+    duplicando el intervalo de espera en cada consulta.
+    """
+    espera = SONDEO_LOTE_INICIAL
+    while True:
+        lote = await cliente.batches.retrieve(lote_id)
+        if lote.status in ("completed", "failed", "expired", "cancelled"):
+            return lote
+
+        conteo = lote.request_counts
+        if conteo:
+            logger.info(
+                f"  Lote {lote_id}: {lote.status} "
+                f"({conteo.completed}/{conteo.total} completadas). "
+                f"Siguiente consulta en {espera}s."
+            )
+        await asyncio.sleep(espera)
+        espera = min(espera * 2, SONDEO_LOTE_MAXIMO)
+
+
+async def _procesar_lote(
+    cliente: AsyncOpenAI, archivos: list[Path]
+) -> tuple[list[dict], list[dict]]:
+    """
+    Procesa los archivos con la Batch API de OpenAI: sube un JSONL con una
+    petición por archivo, espera a que el lote termine y valida cada respuesta.
+    Cuesta la mitad que las peticiones síncronas a cambio de hasta 24 h de espera.
+    """
+    resultados = []
+    errores = []
+    pendientes = [p async for p in _leer_pendientes(archivos, resultados, errores)]
+
+    por_nombre = {}
+    lineas = []
+    for archivo, texto in pendientes:
+        por_nombre[archivo.name] = (archivo, texto)
+        lineas.append(orjson.dumps({
+            "custom_id": archivo.name,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": MODELO_OPENAI,
+                "temperature": TEMPERATURA,
+                "messages": construir_mensajes([texto]),
+                "response_format": FORMATO_RESPUESTA,
+            },
+        }))
+
+    if not lineas:
+        return resultados, errores
+
+    entrada = await cliente.files.create(
+        file=("lote.jsonl", b"\n".join(lineas)),
+        purpose="batch",
+    )
+    lote = await cliente.batches.create(
+        input_file_id=entrada.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    logger.info(f"Lote enviado: {lote.id} ({len(lineas)} petición(es)).")
+
+    lote = await _esperar_lote(cliente, lote.id)
+    if lote.status != "completed":
+        logger.warning(f"El lote {lote.id} terminó con estado '{lote.status}'; se usan los resultados parciales.")
+
+    # Las respuestas correctas llegan en output_file_id y las peticiones fallidas
+    # en error_file_id; cada archivo solo existe si el lote produjo líneas de ese tipo
+    lineas_salida = []
+    for archivo_id in (lote.output_file_id, lote.error_file_id):
+        if archivo_id:
+            salida = await cliente.files.content(archivo_id)
+            lineas_salida.extend(salida.content.splitlines())
+
+    for linea in lineas_salida:
+        if not linea.strip():
+            continue
+        registro = orjson.loads(linea)
+        pendiente = por_nombre.pop(registro["custom_id"], None)
+        if pendiente is None:
+            continue
+        archivo, texto = pendiente
+
+        respuesta = registro.get("response") or {}
+        if registro.get("error") or respuesta.get("status_code") != 200:
+            error = registro.get("error") or respuesta.get("body", {}).get("error")
+            logger.error(f"  [{archivo.name}] ERROR FATAL: {error}")
+            errores.append({"archivo": archivo.name, "error": str(error)})
+            continue
+
+        try:
+            mensaje = respuesta["body"]["choices"][0]["message"]
+            if mensaje.get("refusal"):
+                raise ValueError(f"La IA rechazó la solicitud: {mensaje['refusal']}")
+            datos = validar_json(mensaje.get("content") or "")[0]
+        except (KeyError, IndexError, TypeError, AttributeError) as e:
+            error = f"Respuesta del lote con formato inesperado: {e!r}"
+            logger.error(f"  [{archivo.name}] ERROR FATAL: {error}")
+            errores.append({"archivo": archivo.name, "error": error})
+            continue
+        except ValueError as e:
+            logger.error(f"  [{archivo.name}] ERROR FATAL: {e}")
+            errores.append({"archivo": archivo.name, "error": str(e)})
+            continue
+        await guardar_cache(texto, datos)
+        resultados.append(_guardar_resultado(archivo, datos))
+
+    # Peticiones sin respuesta (fallidas o no ejecutadas antes de expirar)
+    for nombre in por_nombre:
+        error = f"Sin respuesta en el lote {lote.id} (estado '{lote.status}')"
+        logger.error(f"  [{nombre}] ERROR FATAL: {error}")
+        errores.append({"archivo": nombre, "error": error})
+
+    return resultados, errores
+
+
+async def _procesar_concurrente(
+    cliente: AsyncOpenAI, archivos: list[Path]
+) -> tuple[list[dict], list[dict]]:
+    """
+    Procesa los archivos con peticiones síncronas concurrentes a OpenAI,
+    agrupando hasta DOCS_POR_PETICION documentos por petición. La lectura
+    de archivos y las peticiones a la API se solapan.
+    """
+    resultados = []
+    errores = []
+    semaforo = asyncio.Semaphore(MAX_CONCURRENCIA)
+    limitador = None
+    grupos = []
+    tareas = []
+
+    async def despachar(grupo: list[tuple[Path, str]]) -> None:
+        nonlocal limitador
+        if limitador is None:
+            # Se crea con el primer grupo: si todo viene de la caché no se consulta la API
+            limitador = await crear_limitador(cliente)
+        grupos.append(grupo)
+        tareas.append(
+            asyncio.create_task(_procesar_grupo(cliente, semaforo, limitador, grupo))
+        )
+
+    # Cada grupo completo se envía en cuanto se termina de leer
+    grupo = []
+    async for pendiente in _leer_pendientes(archivos, resultados, errores):
+        grupo.append(pendiente)
+        if len(grupo) == DOCS_POR_PETICION:
+            await despachar(grupo)
+            grupo = []
+    if grupo:
+        await despachar(grupo)
+
+    salidas = await asyncio.gather(*tareas, return_exceptions=True)
+
+    for grupo, salida in zip(grupos, salidas):
+        if isinstance(salida, (RuntimeError, ValueError, OSError)):
+            for archivo, _ in grupo:
+                logger.error(f"  [{archivo.name}] ERROR FATAL: {salida}")
+                errores.append({"archivo": archivo.name, "error": str(salida)})
+        elif isinstance(salida, BaseException):
+            raise salida
+        else:
+            resultados.extend(salida[0])
+            errores.extend(salida[1])
+
+    return resultados, errores
+
+
+async def procesar_archivos(
+    usar_batch: bool = False,
+    usar_cache_semantica: bool = False,
+    forzar: bool = False,
+) -> list[dict]:
     """
     Procesa todos los archivos soportados del directorio de entrada.
     Formatos: .txt, .pdf, .docx, .xlsx, .xls
-    Retorna una lista de resultados estructurados.
+    Las peticiones a OpenAI se envían de forma concurrente (hasta
+    MAX_CONCURRENCIA a la vez), o como un único lote de la Batch API
+    si usar_batch es True. Con usar_cache_semantica, los documentos casi
+    idénticos a uno ya procesado reutilizan sus datos.
+    Los archivos que ya tienen su JSON en OUTPUT_DIR se omiten, salvo que
+    forzar sea True. Retorna una lista de resultados estructurados.
     """
+    global _cache_semantica
+
     cliente = crear_cliente_openai()
 
     # Crear directorio de salida
@@ -292,35 +1252,37 @@ def procesar_archivos() -> list[dict]:
 
     logger.info(f"Se encontraron {len(archivos)} archivo(s) para procesar.\n")
 
-    resultados = []
-    errores = []
+    previos = []
+    if not forzar:
+        archivos, previos = _omitir_procesados(archivos)
+        if previos:
+            logger.info(
+                f"Se omiten {len(previos)} archivo(s) ya procesados "
+                f"(usar --force para reprocesarlos).\n"
+            )
 
-    for archivo in archivos:
-        logger.info(f"Procesando: {archivo.name}")
+    if usar_cache_semantica:
+        # Importación diferida: sentence-transformers y faiss solo son necesarios aquí
+        from semantic_cache import CacheSemantica
 
-        try:
-            texto = leer_archivo(archivo)
-            datos = extraer_datos(cliente, texto)
-
-            # Agregar metadatos
-            resultado = {
-                "archivo_origen": archivo.name,
-                "datos_extraidos": datos,
-                "procesado_en": datetime.now().isoformat(),
-            }
-            resultados.append(resultado)
-
-            # Guardar resultado individual
-            salida_individual = OUTPUT_DIR / f"{archivo.stem}_resultado.json"
-            salida_individual.write_text(
-                json.dumps(datos, indent=2, ensure_ascii=False),
-                encoding="utf-8",
-            )
-            logger.info(f"  Guardado: {salida_individual.name}\n")
+        _cache_semantica = CacheSemantica(
+            CACHE_SEMANTICA_RUTA, f"{MODELO_OPENAI}|{PROMPT_VERSION}"
+        )
 
-        except RuntimeError as e:
-            logger.error(f"  ERROR FATAL: {e}\n")
-            errores.append({"archivo": archivo.name, "error": str(e)})
+    resultados, errores = [], []
+    if archivos:
+        async with cliente:
+            if usar_batch:
+                resultados, errores = await _procesar_lote(cliente, archivos)
+            else:
+                resultados, errores = await _procesar_concurrente(cliente, archivos)
+    resultados += previos
+
+    if _cache_semantica is not None:
+        _cache_semantica.guardar()
+
+    resultados.sort(key=lambda r: r["archivo_origen"])
+    errores.sort(key=lambda e: e["archivo"])
 
     # Guardar resumen consolidado
     resumen = {
@@ -332,10 +1294,7 @@ def procesar_archivos() -> list[dict]:
     }
 
     ruta_resumen = OUTPUT_DIR / "resumen_completo.json"
-    ruta_resumen.write_text(
-        json.dumps(resumen, indent=2, ensure_ascii=False),
-        encoding="utf-8",
-    )
+    ruta_resumen.write_bytes(orjson.dumps(resumen, option=orjson.OPT_INDENT_2))
     logger.info(f"Resumen guardado en: {ruta_resumen}")
 
     # Resumen final
@@ -349,12 +1308,38 @@ def procesar_archivos() -> list[dict]:
 # ── Punto de entrada ─────────────────────────────────────────────────────────
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convierte texto desordenado en JSON estructurado usando OpenAI."
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Usar la Batch API de OpenAI (50%% más barata, resultados en hasta 24 h).",
+    )
+    parser.add_argument(
+        "--cache-semantica",
+        action="store_true",
+        help="Reutilizar los datos de documentos casi idénticos (requiere sentence-transformers y faiss).",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Reprocesar también los archivos que ya tienen su JSON en datos_salida/.",
+    )
+    args = parser.parse_args()
+
     try:
-        resultados = procesar_archivos()
+        resultados = asyncio.run(
+            procesar_archivos(
+                usar_batch=args.batch,
+                usar_cache_semantica=args.cache_semantica,
+                forzar=args.force,
+            )
+        )
         if resultados:
             print("\n📋 Ejemplo de salida JSON extraída:")
-            print(json.dumps(resultados[0]["datos_extraidos"], indent=2, ensure_ascii=False))
-    except EnvironmentError as e:
+            print(orjson.dumps(resultados[0]["datos_extraidos"], option=orjson.OPT_INDENT_2).decode())
+    except (EnvironmentError, RuntimeError) as e:
         logger.error(e)
         sys.exit(1)
     except KeyboardInterrupt:
@@ -0,0 +1,100 @@
+"""
+PlanetaFiscal - Caché semántica
+===============================
+Reutiliza los datos extraídos de documentos casi idénticos (misma plantilla,
+mismo contenido) comparando embeddings locales, sin llamar a la API de OpenAI.
+Complementa la caché exacta por hash: se consulta solo cuando esta falla.
+"""
+
+import asyncio
+import logging
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+import faiss
+import numpy as np
+from sentence_transformers import SentenceTransformer
+
+MODELO_EMBEDDINGS = "all-MiniLM-L6-v2"
+UMBRAL_SIMILITUD = 0.97  # Similitud coseno mínima para considerar un acierto
+
+logger = logging.getLogger("PlanetaFiscal")
+
+
+class CacheSemantica:
+    """
+    Índice FAISS de embeddings normalizados (producto interno = similitud
+    coseno) junto con los datos extraídos de cada texto.
+    Se persiste en un archivo pickle; si `version` no coincide con la guardada
+    (otro modelo o prompt), el índice se descarta y se empieza de cero.
+    Los embeddings y las consultas al índice se ejecutan en un hilo propio:
+    no bloquean el bucle de eventos y el índice nunca se usa en paralelo.
+    """
+
+    def __init__(self, ruta: Path, version: str, umbral: float = UMBRAL_SIMILITUD):
+        self.ruta = ruta
+        self.version = f"{version}|{MODELO_EMBEDDINGS}"
+        self.umbral = umbral
+        self._modelo = SentenceTransformer(MODELO_EMBEDDINGS, device="cpu")
+        self._indice = faiss.IndexFlatIP(self._modelo.get_sentence_embedding_dimension())
+        self._datos: list[dict] = []
+        self._ejecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cache-semantica")
+        self._cargar()
+
+    def _vectorizar(self, texto: str) -> np.ndarray:
+        """Calcula el embedding normalizado de un texto como matriz (1, dim)."""
+        vector = self._modelo.encode([texto], normalize_embeddings=True, convert_to_numpy=True)
+        return vector.astype(np.float32)
+
+    def _cargar(self) -> None:
+        """Carga el índice guardado si existe y corresponde a la versión actual."""
+        try:
+            with self.ruta.open("rb") as f:
+                guardado = pickle.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            logger.warning(f"No se pudo cargar la caché semántica ({e}); se empieza vacía.")
+            return
+
+        if guardado.get("version") != self.version:
+            logger.info("La caché semántica es de otra versión de modelo/prompt; se descarta.")
+            return
+
+        if guardado["datos"]:
+            self._indice.add(guardado["embeddings"])
+            self._datos = guardado["datos"]
+
+    async def buscar(self, texto: str) -> Optional[dict]:
+        """Retorna los datos del texto más parecido si supera el umbral, o None."""
+        return await asyncio.get_running_loop().run_in_executor(self._ejecutor, self._buscar, texto)
+
+    async def agregar(self, texto: str, datos: dict) -> None:
+        """Agrega un texto y sus datos extraídos al índice."""
+        await asyncio.get_running_loop().run_in_executor(self._ejecutor, self._agregar, texto, datos)
+
+    def _buscar(self, texto: str) -> Optional[dict]:
+        if self._indice.ntotal == 0:
+            return None
+        similitudes, indices = self._indice.search(self._vectorizar(texto), 1)
+        if similitudes[0][0] < self.umbral:
+            return None
+        logger.debug(f"  Acierto semántico (similitud {similitudes[0][0]:.3f}).")
+        return self._datos[indices[0][0]]
+
+    def _agregar(self, texto: str, datos: dict) -> None:
+        self._indice.add(self._vectorizar(texto))
+        self._datos.append(datos)
+
+    def guardar(self) -> None:
+        """Persiste el índice y los datos en disco."""
+        self.ruta.parent.mkdir(parents=True, exist_ok=True)
+        guardado = {
+            "version": self.version,
+            "embeddings": self._indice.reconstruct_n(0, self._indice.ntotal),
+            "datos": self._datos,
+        }
+        with self.ruta.open("wb") as f:
+            pickle.dump(guardado, f)